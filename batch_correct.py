@@ -19,8 +19,18 @@ ADAPTIVE_METHOD = 0
 BLOCK_SIZE = 101
 RADIUS = 50
 MIN_SIZE = 20000
-RAW_SUFFIX_LST = ['RAW', 'raw', 'ARW', 'arw', 'NEF', 'nef']
-TIF_PNG_SUFFIX_LST = ['TIFF', 'tiff', 'TIF', 'tif', 'PNG', 'png']
+
+# (image decoding, detection resolution, caching and TIFF output settings are
+# shared by all scripts and set in color_correct_utils.py)
+
+# default number of worker processes (number of CPU cores, but at most this
+# many): every worker holds the current, the next and the previous image (of
+# 24 MP: about 0.7 GB per worker, 2 GB without numba, see README), and the
+# numba kernels of fewer workers still use all cores
+MAX_DEFAULT_PROCESSES = 4
+
+# number of upcoming images per worker to prefetch into the page cache
+PREFETCH_DEPTH = 4
 
 
 
@@ -30,6 +40,9 @@ TIF_PNG_SUFFIX_LST = ['TIFF', 'tiff', 'TIF', 'tif', 'PNG', 'png']
 import argparse
 import sys
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 
 
@@ -38,12 +51,9 @@ import os
 def cli():
 
     '''
-    Parse command line arguments.
+    Parse and return command line arguments.
     '''
 
-    global input_dir_path, output_dir_path, review_dir_path, ref_path, \
-        img_format, icc_profile_path
-
     parser = argparse.ArgumentParser(description="Batch-color correct RAW \
         image files.")
 
@@ -54,7 +64,7 @@ def cli():
         directory to which color-corrected TIFF files will be saved')
     parser.add_argument('review_dir_path', type=str, help='Path to the PlantCV \
         debug directory which will contain PNGs with the masked color card for \
-        review')
+        review (only written with --review)')
     parser.add_argument('ref_path', type=str, help='Path to the RAW \
         (or PNG/TIFF) image serving as the reference for for color correction \
         (or previously extracted reference color matrix in TSV format)')
@@ -64,217 +74,155 @@ def cli():
     parser.add_argument('icc_profile_path', type=str, help='Path to the ICC \
         color profile to be embedded in the output TIFFs, for example the \
         supplied sRGB profile: data/sRGB_profile.icc')
+    parser.add_argument('-p', '--processes', type=int,
+        default=min(MAX_DEFAULT_PROCESSES, os.cpu_count()), help='Number of \
+        images to process in parallel; each process needs about 0.7 GB of \
+        memory for 24 MP images (2 GB without numba) (default: number of CPU \
+        cores, at most 4)')
+    parser.add_argument('--review', action=argparse.BooleanOptionalAction,
+        default=False, help='Write PNGs with the masked color card to \
+        <review_dir_path> for the reference and every --review_interval-th \
+        image (default: off)')
+    parser.add_argument('--review_interval', type=int, default=1,
+        help='With --review, write PNGs for every n-th image only (default: \
+        1, i.e. all images)')
+    parser.add_argument('--cache_ref', action=argparse.BooleanOptionalAction,
+        default=True, help='Cache the reference color matrix extracted from \
+        <ref_path> in ~/.cache/color_correction and reuse it while the image \
+        and the detection settings are unchanged (default: on)')
+    parser.add_argument('--cache_masks', action=argparse.BooleanOptionalAction,
+        default=False, help='Cache color card masks in \
+        ~/.cache/color_correction/masks and reuse them for unchanged images \
+        on re-runs (default: off)')
 
     # parse
     args = parser.parse_args()
 
-    # reassign variable names
-    input_dir_path, output_dir_path, review_dir_path, ref_path, \
-        img_format, icc_profile_path = args.input_dir_path, \
-        args.output_dir_path, args.review_dir_path, args.ref_path, \
-        args.img_format, args.icc_profile_path
-
-
+    # every n-th image is reviewed, so n must be positive
+    if args.review_interval < 1:
+        parser.error('--review_interval must be at least 1')
 
-## FUNCTIONS
-
-def check_make_dir(dir_path):
+    return args
 
-    '''
-    Check if a directory exists, if not, create it.
-    '''
 
-    if not os.path.isdir(dir_path):
-        os.mkdir(dir_path)
 
+## FUNCTIONS
 
-def detect_color_card(image_path, img_format, ADAPTIVE_METHOD, BLOCK_SIZE, \
-        RADIUS, MIN_SIZE, RAW_SUFFIX_LST, TIF_PNG_SUFFIX_LST):
+def import_packages():
 
     '''
-    Read in 8 bit image using auto brightness, autoscaling, no 4-channel-RGB,
-    no gamma supression. Return color card mask.
+    Import remaining packages into the module namespace (including the shared
+    helpers in color_correct_utils.py). This is deferred until after argument
+    parsing and repeated in every worker process.
     '''
 
-    # enable debug/print
-    pcv.params.debug = 'print'
-
-    # read RAW
-    if img_format in RAW_SUFFIX_LST:
-
-        # read RAW
-        raw = rawpy.imread(image_path)
-
-        # convert to RGB
-        rgb = raw.postprocess(
-            output_bps=8,
-            no_auto_bright=False,
-            use_camera_wb=False,
-            use_auto_wb=True,
-            no_auto_scale=False,
-            four_color_rgb=False,
-            output_color=rawpy.ColorSpace.sRGB,
-        )
-
-        # rearrange channels because plantcv expects BGR
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-
-    # read TIFF/PNG
-    elif img_format in TIF_PNG_SUFFIX_LST:
-
-        bgr = cv2.imread(image_path, cv2.IMREAD_COLOR)
-
-    # else print error message and exit
-    else:
-        print(
-            '[ERROR] images must be either in a RAW, TIFF or PNG format',
-             file=sys.stderr,
-        )
-        sys.exit()
+    global pcv, np, plt, utils, kernels
 
-    # detect color card
-    card_mask = pcv.transform.detect_color_card(
-        rgb_img=bgr,
-        label=image_path.split('/')[-1].split('_')[0],
-        adaptive_method=ADAPTIVE_METHOD,
-        block_size=BLOCK_SIZE,
-        radius=RADIUS,
-        min_size=MIN_SIZE,
-        )
+    from plantcv import plantcv as pcv
+    import numpy as np
+    import matplotlib.pyplot as plt
+    import color_correct_utils as utils
 
-    return card_mask
+    # numba-compiled kernels are optional (fall back to NumPy/PlantCV)
+    try:
+        import color_correct_kernels as kernels
+    except ImportError:
+        kernels = None
 
 
-def get_ref_color_matrix(ref_path, img_format, ADAPTIVE_METHOD, BLOCK_SIZE, \
-        RADIUS, MIN_SIZE, RAW_SUFFIX_LST, TIF_PNG_SUFFIX_LST):
+def init_worker(review_dir_path, icc_profile_path, n_threads):
 
     '''
-    Extract reference color matrix from a RAW/PNG/TIFF image: First detect
-    color card with detect_color_card(), then read it in again as in
-    apply_color_correction() and extract color mask.
+    Set up a worker process: import packages, point PlantCV to the review
+    directory, limit the numba kernels to n_threads threads (so that the
+    workers together do not oversubscribe the CPU) and read the ICC color
+    profile once per worker (instead of sending it along with every task).
     '''
 
-    # enable debug/print
-    pcv.params.debug = 'print'
-
-    # get color profile from reference image
-    ref_card_mask = detect_color_card(
-        ref_path,
-        img_format,
-        ADAPTIVE_METHOD,
-        BLOCK_SIZE,
-        RADIUS,
-        MIN_SIZE,
-        RAW_SUFFIX_LST,
-        TIF_PNG_SUFFIX_LST,
-    )
-
-    # disable debug/print
-    pcv.params.debug = None
+    global icc_profile
 
-    # read RAW
-    if img_format in RAW_SUFFIX_LST:
-
-        # read RAW
-        raw = rawpy.imread(ref_path)
-
-        # convert to RGB
-        rgb = raw.postprocess(
-            output_bps=8,
-            no_auto_bright=True,
-            use_camera_wb=False,
-            use_auto_wb=False,
-            no_auto_scale=False,
-            four_color_rgb=False,
-            output_color=rawpy.ColorSpace.sRGB,
-        )
+    import_packages()
+    pcv.params.debug_outdir = review_dir_path
+    if kernels is not None:
+        kernels.set_threads(n_threads)
 
-        # rearrange channels because plantcv expects BGR
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    with open(icc_profile_path, "rb") as f:
+        icc_profile = f.read()
 
-    # read TIFF/PNG
-    else:
 
-        bgr = cv2.imread(ref_path, cv2.IMREAD_COLOR)
+def natural_sort_key(file_name, _digit_regex=re.compile(r'(\d+)')):
 
-    # derive color card matrix
-    _, ref_color_matrix = pcv.transform.get_color_matrix(
-        rgb_img=bgr,
-        mask=ref_card_mask
-    )
+    '''
+    Sort key that orders numbered file names naturally (e.g. IMG_9.ARW before
+    IMG_10.ARW).
+    '''
 
-    return ref_color_matrix
+    return [
+        int(token) if token.isdigit() else token
+        for token in _digit_regex.split(file_name)
+    ]
 
 
-def read_ref_color_matrix(ref_path):
+def prefetch_files(path_lst):
 
     '''
-    Read in previously extracted reference color matrix
+    Ask the kernel to read files into the page cache in the background, so
+    that reading them later does not block on disk I/O (no-op on platforms
+    without posix_fadvise).
     '''
 
-    ref_color_matrix = np.loadtxt(
-        ref_path,
-        delimiter='\t'
-    )
+    if not hasattr(os, 'posix_fadvise'):
+        return
 
-    return ref_color_matrix
+    for path in path_lst:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
 
 
-def apply_color_correction(image_path, card_mask, ref_color_matrix):
+def apply_color_correction(bgr, card_mask, ref_color_matrix, image_path):
 
     '''
-    Read in 8 bit image with no auto brightness, no WB adjustment, 
-    4-channel-RGB, no gamma correction. Using  card_mask, derive card_matrix 
-    and adjust colors using ref_color_matrix. Return color-corrected RGB image.
+    Using card_mask, derive card_matrix from a BGR image (as read in for
+    color correction by read_image()) and adjust colors using
+    ref_color_matrix. Return color-corrected RGB image.
     '''
 
     # disable debug/print
     pcv.params.debug = None
 
-    # read RAW
-    if img_format in RAW_SUFFIX_LST:
-
-        # read RAW
-        raw = rawpy.imread(image_path)
-
-        # convert to RGB
-        rgb = raw.postprocess(
-            output_bps=8,
-            no_auto_bright=True,
-            use_camera_wb=False,
-            use_auto_wb=False,
-            no_auto_scale=False,
-            four_color_rgb=False,
-            output_color=rawpy.ColorSpace.sRGB,
-        )
-
-        # rearrange channels because plantcv expects BGR
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-
-    # read TIFF/PNG
-    else:
-
-        bgr = cv2.imread(image_path, cv2.IMREAD_COLOR)
-
     # derive color card matrix
-    _, color_matrix = pcv.transform.get_color_matrix(
-        rgb_img=bgr,
-        mask=card_mask
-    )
+    color_matrix = utils.extract_color_matrix(bgr, card_mask)
+
+    # the comparison below requires matrices of the same shape
+    if color_matrix.shape != ref_color_matrix.shape:
+        raise RuntimeError(
+            f'{image_path}: Color matrix shape {color_matrix.shape} does not '
+            f'match reference color matrix shape {ref_color_matrix.shape}'
+        )
 
-    # derive upside-down color card matrix
-    card_mask_ud = np.flipud(card_mask)
-    _, color_matrix_ud = pcv.transform.get_color_matrix(
-        rgb_img=bgr,
-        mask=card_mask_ud
+    # derive upside-down color card matrix: rotating the card by 180°
+    # reverses the order of the chips, so reverse the color rows (but keep
+    # the chip numbers) instead of scanning the image again
+    color_matrix_ud = np.column_stack(
+        (color_matrix[:, 0], color_matrix[::-1, 1:])
     )
 
     # compute “distance” to reference matrix (sum of squared differences)
-    diff_normal = np.linalg.norm(color_matrix - ref_color_matrix)
-    diff_flipped = np.linalg.norm(color_matrix_ud - ref_color_matrix)
-
-    # select correct orientation
-    if diff_normal >= diff_flipped:
+    # and select correct orientation
+    if kernels is not None:
+        upside_down = kernels.compare_matrices(
+            color_matrix,
+            color_matrix_ud,
+            ref_color_matrix,
+        )
+    else:
+        diff = np.stack((color_matrix, color_matrix_ud)) - ref_color_matrix
+        diff_normal, diff_flipped = np.einsum('ijk,ijk->i', diff, diff)
+        upside_down = diff_normal >= diff_flipped
+    if upside_down:
         print(
             f'[INFO] {image_path}: Color card upside down',
             file=sys.stderr,
@@ -282,111 +230,250 @@ def apply_color_correction(image_path, card_mask, ref_color_matrix):
         color_matrix = color_matrix_ud
 
     # correct colors
-    bgr_corr = pcv.transform.affine_color_correction(
-        rgb_img=bgr,
-        source_matrix=color_matrix,
-        target_matrix=ref_color_matrix
-    )
+    if kernels is not None:
+        bgr_corr = kernels.affine_color_correction(
+            bgr,
+            color_matrix,
+            ref_color_matrix,
+        )
+    else:
+        bgr_corr = pcv.transform.affine_color_correction(
+            rgb_img=bgr,
+            source_matrix=color_matrix,
+            target_matrix=ref_color_matrix
+        )
 
-    # convert back to RGB
-    rgb_corr = cv2.cvtColor(bgr_corr, cv2.COLOR_BGR2RGB)
+    # convert back to RGB (reversed channel view, no copy)
+    rgb_corr = bgr_corr[..., ::-1]
 
     return rgb_corr
 
 
+def process_images(image_lst, input_dir_path, output_dir_path, \
+        ref_color_matrix, img_format, review, review_interval, \
+        cache_masks):
+
+    '''
+    Detect color card, apply correction and save as TIFF for a share of
+    images given as (index, file name) tuples (runs in a worker process set
+    up by init_worker()). Reading and saving run in background threads, so
+    that the next image is read in and the previous one is saved while the
+    current one is corrected.
+    '''
+
+    image_path_lst = [f'{input_dir_path}/{image}' for _, image in image_lst]
+
+    with ThreadPoolExecutor(max_workers=1) as reader, \
+        ThreadPoolExecutor(max_workers=1) as writer:
+
+        # prefetch first images and start reading the first one
+        prefetch_files(image_path_lst[:PREFETCH_DEPTH + 1])
+        read_future = reader.submit(
+            utils.read_image,
+            image_path_lst[0],
+            img_format,
+        )
+        write_future = None
+
+        for i, (idx, image) in enumerate(image_lst):
+
+            # wait for current image, then start reading the next one and
+            # prefetch the one entering the prefetch window
+            bgr_detect, bgr = read_future.result()
+            prefetch_files(image_path_lst[i + PREFETCH_DEPTH + 1:][:1])
+            if i + 1 < len(image_lst):
+                read_future = reader.submit(
+                    utils.read_image,
+                    image_path_lst[i + 1],
+                    img_format,
+                )
+
+            # number review PNGs as in sequential processing (the reference
+            # is 0)
+            pcv.params.device = idx + 1
+
+            # detect color card (optionally reusing the mask of a previous
+            # run)
+            mask_cache_path = utils.get_mask_cache_path(
+                image_path_lst[i],
+                ADAPTIVE_METHOD,
+                BLOCK_SIZE,
+                RADIUS,
+                MIN_SIZE,
+            ) if cache_masks else None
+            card_mask = utils.detect_color_card(
+                bgr_detect,
+                bgr,
+                image.split('_', 1)[0],
+                ADAPTIVE_METHOD,
+                BLOCK_SIZE,
+                RADIUS,
+                MIN_SIZE,
+                review and (idx + 1) % review_interval == 0,
+                mask_cache_path,
+                image_path_lst[i],
+                img_format,
+            )
+
+            # close plt images from plantcv
+            plt.close('all')
+
+            # apply correction
+            rgb_corr = apply_color_correction(
+                bgr,
+                card_mask,
+                ref_color_matrix,
+                image_path_lst[i],
+            )
+
+            # wait for previous image to be saved, then save in background
+            if write_future is not None:
+                write_future.result()
+            out_image = f'{os.path.splitext(image)[0]}.tiff'
+            write_future = writer.submit(
+                utils.save_image,
+                rgb_corr,
+                f'{output_dir_path}/{out_image}',
+                icc_profile,
+            )
+
+        # wait for last image to be saved
+        write_future.result()
+
+
 
 ## MAIN
 
 def main():
 
     # parse arguments
-    cli()
+    args = cli()
 
     # import remaining packages
-    import rawpy
-    import cv2
-    from plantcv import plantcv as pcv
-    from PIL import Image
-    import numpy as np
-    import matplotlib.pyplot as plt
+    import_packages()
 
     # make directories if they don't exist
-    check_make_dir(review_dir_path)
-    check_make_dir(output_dir_path)
+    if args.review:
+        utils.check_make_dir(args.review_dir_path)
+    utils.check_make_dir(args.output_dir_path)
 
     # set up PlantCV (i.e. set debugging directory )
-    pcv.params.debug_outdir = review_dir_path
-
-    # fetch target images & sort
-    target_image_lst = [
-        x for x in os.listdir(input_dir_path)
-        if x.lower().endswith(img_format.lower())
-    ]
-    target_image_lst.sort()
+    pcv.params.debug_outdir = args.review_dir_path
+
+    # fetch target images (scandir entries know whether they are files
+    # without an extra stat call) & sort naturally; outputs are independent,
+    # but the order determines review PNG numbering & worker shares
+    suffix = args.img_format.lower()
+    suffix_tpl = tuple({args.img_format, suffix, args.img_format.upper()})
+    target_image_lst = sorted(
+        (
+            entry.name for entry in os.scandir(args.input_dir_path)
+            if entry.name.endswith(suffix_tpl) and entry.is_file()
+        ),
+        key=natural_sort_key,
+    )
 
-    # read ICC color profile
-    with open(icc_profile_path, "rb") as f:
-        icc_profile = f.read()
+    # check ICC color profile (read in by every worker)
+    if not os.path.isfile(args.icc_profile_path):
+        print(
+            f'[ERROR] ICC color profile not found: {args.icc_profile_path}',
+             file=sys.stderr,
+        )
+        sys.exit()
 
     # extract reference/target color mask
-    if img_format in RAW_SUFFIX_LST + TIF_PNG_SUFFIX_LST \
-        and ref_path.lower().endswith(img_format.lower()):
-        ref_color_matrix = get_ref_color_matrix(
-            ref_path,
-            img_format,
-            ADAPTIVE_METHOD,
-            BLOCK_SIZE,
-            RADIUS,
-            MIN_SIZE,
-            RAW_SUFFIX_LST,
-            TIF_PNG_SUFFIX_LST,
-        )
-    elif ref_path.endswith('.tsv'):
-        ref_color_matrix = read_ref_color_matrix(
-            ref_path,
+    if args.img_format in utils.RAW_SUFFIX_SET | utils.TIF_PNG_SUFFIX_SET \
+        and args.ref_path.lower().endswith(suffix):
+
+        # load cached reference color matrix if available
+        ref_color_matrix = None
+        if args.cache_ref:
+            ref_cache_path = utils.get_ref_cache_path(
+                args.ref_path,
+                ADAPTIVE_METHOD,
+                BLOCK_SIZE,
+                RADIUS,
+                MIN_SIZE,
+            )
+            ref_color_matrix = utils.read_cache_file(ref_cache_path)
+        if ref_color_matrix is not None:
+            print(
+                f'[INFO] {args.ref_path}: Using cached reference color matrix '
+                f'({ref_cache_path})',
+                file=sys.stderr,
+            )
+
+        # else extract and cache it
+        else:
+            ref_color_matrix = utils.get_ref_color_matrix(
+                *utils.read_image(args.ref_path, args.img_format),
+                args.ref_path,
+                args.img_format,
+                ADAPTIVE_METHOD,
+                BLOCK_SIZE,
+                RADIUS,
+                MIN_SIZE,
+                args.review,
+            )
+            if args.cache_ref:
+                utils.write_cache_file(
+                    ref_cache_path,
+                    np.save,
+                    ref_color_matrix,
+                )
+
+    elif args.ref_path.endswith('.tsv'):
+        ref_color_matrix = utils.read_ref_color_matrix(
+            args.ref_path,
         )
     else:
         print(
-            f'[ERROR] <ref_path> must be either in {img_format} or .tsv'
+            f'[ERROR] <ref_path> must be either in {args.img_format} or .tsv'
              ' format',
              file=sys.stderr,
         )
         sys.exit()
 
-    # process images
-    for image in target_image_lst:
-
-        # detect color card
-        card_mask = detect_color_card(
-            f'{input_dir_path}/{image}',
-            img_format,
-            ADAPTIVE_METHOD,
-            BLOCK_SIZE,
-            RADIUS,
-            MIN_SIZE,
-            RAW_SUFFIX_LST,
-            TIF_PNG_SUFFIX_LST,
-        )
-
-        # close plt images from plantcv
-        plt.close('all')
-
-        # apply correction
-        rgb_corr = apply_color_correction(
-            f'{input_dir_path}/{image}',
-            card_mask,
-            ref_color_matrix,
-        )
+    # keep color matrices in float32 (like the matrices of target images)
+    ref_color_matrix = ref_color_matrix.astype(np.float32)
+
+    # compile numba kernels once before starting workers, which then load
+    # them from the on-disk cache instead of compiling them in every process;
+    # this runs in a separate process because loading numba's threading layer
+    # in the parent before forking workers can leave it hanging on exit
+    if kernels is not None:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            executor.submit(kernels.warm_up).result()
+
+    # split images into one share per worker (keep index for review PNGs)
+    n_workers = max(1, min(args.processes, len(target_image_lst)))
+    indexed_image_lst = list(enumerate(target_image_lst))
+    share_lst = [
+        indexed_image_lst[i::n_workers] for i in range(n_workers)
+        if indexed_image_lst[i::n_workers]
+    ]
 
-        # save
-        pil_img = Image.fromarray(rgb_corr)
-        out_image = f'{os.path.splitext(image)[0]}.tiff'
-        pil_img.save(
-            f"{output_dir_path}/{out_image}",
-            format="TIFF",
-            icc_profile=icc_profile,
-            compression='tiff_adobe_deflate',
-        )
+    # process shares in parallel, each worker only receives the file names
+    process_fn = partial(
+        process_images,
+        input_dir_path=args.input_dir_path,
+        output_dir_path=args.output_dir_path,
+        ref_color_matrix=ref_color_matrix,
+        img_format=args.img_format,
+        review=args.review,
+        review_interval=args.review_interval,
+        cache_masks=args.cache_masks,
+    )
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_worker,
+        initargs=(
+            args.review_dir_path,
+            args.icc_profile_path,
+            os.cpu_count() // n_workers,
+        ),
+    ) as executor:
+        list(executor.map(process_fn, share_lst))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Numba-compiled kernels for comparing color matrices and applying affine
+# color corrections (optional, imported by batch_correct.py and
+# correct_from_proxy.py if numba is installed)
+
+
+
+## SETUP
+
+#  import packages
+import numpy as np
+from numba import config, njit, prange, set_num_threads
+
+
+
+## KERNELS
+
+@njit(cache=True, fastmath=True)
+def compare_matrices(a, b, ref):
+
+    '''
+    Return True if color matrix b is at least as close to the reference color
+    matrix as color matrix a (sum of squared differences, computed in a single
+    pass without temporary arrays).
+    '''
+
+    d_a = 0.0
+    d_b = 0.0
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            x = a[i, j] - ref[i, j]
+            y = b[i, j] - ref[i, j]
+            d_a += x * x
+            d_b += y * y
+
+    return d_b <= d_a
+
+
+@njit(cache=True)
+def affine_coefficients(source_matrix, target_matrix):
+
+    '''
+    Fit affine transformation from source to target color matrix (columns:
+    chip number, R, G, B) by least squares as in PlantCV's
+    affine_color_correction(). Return 4x3 coefficient matrix (rows: R, G, B,
+    constant; columns: corrected R, G, B).
+    '''
+
+    # fit in float64 regardless of the dtype of the (tiny) color matrices (the
+    # pseudo-inverse depends on the source matrix, i.e. on every image)
+    n = source_matrix.shape[0]
+    s = np.ones((n, 4))
+    s[:, :3] = source_matrix[:, 1:]
+    t = np.empty((n, 3))
+    t[:] = target_matrix[:, 1:]
+
+    return np.linalg.pinv(s) @ t
+
+
+@njit(cache=True, parallel=True, fastmath=True, boundscheck=False)
+def apply_affine_u8(bgr, m, bias, bgr_corr):
+
+    '''
+    Apply affine transformation (3x3 matrix m and bias in [0-255] units, both
+    float32) to every pixel of a BGR uint8 image and write the clipped result
+    to the uint8 array bgr_corr. Each thread processes whole rows and every
+    pixel is transformed in registers, so no intermediate arrays are
+    allocated.
+    '''
+
+    h, w, _ = bgr.shape
+
+    for i in prange(h):
+        for j in range(w):
+            r = np.float32(bgr[i, j, 2])
+            g = np.float32(bgr[i, j, 1])
+            b = np.float32(bgr[i, j, 0])
+            for c in range(3):
+                v = r * m[0, c] + g * m[1, c] + b * m[2, c] + bias[c]
+                if v < 0:
+                    v = 0
+                elif v > 255:
+                    v = 255
+                bgr_corr[i, j, 2 - c] = np.uint8(v)
+
+
+def affine_color_correction(bgr, source_matrix, target_matrix, rgb=False):
+
+    '''
+    Drop-in replacement for PlantCV's affine_color_correction(): fit affine
+    transformation with affine_coefficients() and apply it with
+    apply_affine_u8(). Return color-corrected BGR image, or RGB image if rgb
+    is set (the channel swap is folded into the transformation). Like
+    PlantCV, raise a RuntimeError if the matrices differ in shape.
+    '''
+
+    # matrices must have the same number of color references
+    if source_matrix.shape != target_matrix.shape:
+        raise RuntimeError("Mismatch between the color matrices' shapes")
+
+    coef = affine_coefficients(source_matrix, target_matrix)
+    m = coef[:3].astype(np.float32)
+    bias = (255 * coef[3]).astype(np.float32)
+
+    # apply_affine_u8() writes corrected R, G, B to channels 2, 1, 0, so
+    # reversing the output columns yields R, G, B in channels 0, 1, 2
+    if rgb:
+        m = np.ascontiguousarray(m[:, ::-1])
+        bias = bias[::-1].copy()
+
+    img_corr = np.empty(bgr.shape, np.uint8)
+    apply_affine_u8(bgr, m, bias, img_corr)
+
+    return img_corr
+
+
+def set_threads(n_threads):
+
+    '''
+    Limit the number of threads the parallel kernels use in this process (to
+    the process' share of the CPU cores when several processes run kernels
+    at the same time).
+    '''
+
+    set_num_threads(max(1, min(n_threads, config.NUMBA_NUM_THREADS)))
+
+
+def warm_up():
+
+    '''
+    Compile all kernels for the argument types used in batch_correct.py and
+    correct_from_proxy.py by calling them on tiny arrays. Compiled code is
+    cached on disk (cache=True), so processes started afterwards load it
+    instead of compiling the kernels again.
+    '''
+
+    color_matrix = np.zeros((24, 4), np.float32)
+    compare_matrices(color_matrix, color_matrix, color_matrix)
+
+    # RAW images are passed as reversed channel views, TIFF/PNG as
+    # contiguous arrays
+    bgr = np.zeros((2, 2, 3), np.uint8)
+    affine_color_correction(bgr, color_matrix, color_matrix)
+    affine_color_correction(bgr[..., ::-1], color_matrix, color_matrix)
@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+#
+# Functions and settings shared by batch_correct.py, correct_from_proxy.py and
+# get_ref_color_matrix.py: reading images, color card detection, color matrix
+# extraction, caching and saving (the scripts share cached reference color
+# matrices and color card masks, so they must derive them the same way)
+
+
+
+## CONFIG
+
+# supported image formats
+RAW_SUFFIX_SET = frozenset(['RAW', 'raw', 'ARW', 'arw', 'NEF', 'nef'])
+TIF_PNG_SUFFIX_SET = frozenset(['TIFF', 'tiff', 'TIF', 'tif', 'PNG', 'png'])
+
+# rawpy postprocessing for color card detection (half resolution without
+# demosaicing, camera WB, which spares LibRaw the auto WB pass, and auto
+# brightness, which keeps 8 bit output bright enough for the adaptive
+# threshold) and for color correction (full resolution, no auto brightness,
+# no WB adjustment)
+POSTPROCESS_KWARGS_DETECT = dict(
+    half_size=True,
+    output_bps=8,
+    no_auto_bright=False,
+    use_camera_wb=True,
+    use_auto_wb=False,
+    no_auto_scale=False,
+    four_color_rgb=False,
+)
+POSTPROCESS_KWARGS_CORRECT = dict(
+    output_bps=8,
+    no_auto_bright=True,
+    use_camera_wb=False,
+    use_auto_wb=False,
+    no_auto_scale=False,
+    four_color_rgb=False,
+)
+
+# detect color card in the JPEG preview embedded in RAW files if available
+# (decodes much faster than postprocessing the RAW data; only used if it has
+# the aspect ratio of the postprocessed image and the image is not rotated)
+DETECT_ON_PREVIEW = True
+
+# maximum size (long edge, in pixels) of the image used for color card
+# detection (larger images are downscaled, detection parameters refer to the
+# full resolution image and are scaled accordingly)
+DETECT_MAX_SIZE = 2000
+
+# version of cached reference color matrices and color card masks (increase
+# when changing how they are derived, so that entries cached by older code
+# are not reused)
+CACHE_VERSION = 2
+
+# lossless compression of output TIFFs (written tiled with tifffile): 'zlib'
+# (Adobe Deflate) is widely supported, level 1 is fast while higher levels give
+# slightly smaller files; 'zstd' and 'lzw' require the imagecodecs package and
+# 'zstd' is not supported by all image editors
+TIFF_COMPRESSION = 'zlib'
+TIFF_COMPRESSION_LEVEL = 1
+TIFF_TILE_SIZE = 256
+
+
+
+## SETUP
+
+#  import packages (rawpy is imported by the functions that read RAW images,
+#  it is only needed for those)
+import hashlib
+import os
+import sys
+import zipfile
+import zlib
+import cv2
+import numpy as np
+import tifffile
+from plantcv import plantcv as pcv
+
+
+
+## FUNCTIONS
+
+def check_make_dir(dir_path):
+
+    '''
+    Check if a directory exists, if not, create it.
+    '''
+
+    if not os.path.isdir(dir_path):
+        os.mkdir(dir_path)
+
+
+def read_preview(raw, shape):
+
+    '''
+    Decode the JPEG preview embedded in an opened RAW file to BGR for color
+    card detection. Return None if there is no JPEG preview, if LibRaw
+    rotates the image (the preview is stored unrotated) or if the preview is
+    not a scaled copy of the postprocessed image (shape), i.e. if their aspect
+    ratios differ by more than rounding of the preview size allows.
+    '''
+
+    import rawpy
+
+    if raw.sizes.flip != 0:
+        return None
+    try:
+        thumb = raw.extract_thumb()
+    except (
+        rawpy.LibRawNoThumbnailError,
+        rawpy.LibRawUnsupportedThumbnailError,
+    ):
+        return None
+    if thumb.format != rawpy.ThumbFormat.JPEG:
+        return None
+
+    bgr_preview = cv2.imdecode(
+        np.frombuffer(thumb.data, np.uint8),
+        cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+    )
+    if bgr_preview is None:
+        return None
+
+    # a preview with a different field of view (e.g. 6000x4000 for a 6048x4024
+    # RAW image) would be stretched instead of offset when scaling the mask up,
+    # which shifts the outer chips, so the preview height scaled to the width
+    # of the postprocessed image may deviate by at most one preview pixel
+    h_preview, w_preview = bgr_preview.shape[:2]
+    if abs(h_preview * shape[1] - w_preview * shape[0]) > shape[1]:
+        return None
+
+    return bgr_preview
+
+
+def read_tiff(image_path):
+
+    '''
+    Read 8 bit RGB TIFF with tifffile, which decodes tiles/strips in parallel
+    (with libdeflate if imagecodecs is installed). Return BGR image (reversed
+    channel view) or None for other TIFFs (e.g. 16 bit, with alpha channel,
+    non-default orientation or compression that tifffile cannot decode
+    without imagecodecs), which are left to OpenCV.
+    '''
+
+    with tifffile.TiffFile(image_path) as tif:
+        page = tif.pages[0]
+        orientation = page.tags.get(274)
+        if page.dtype != np.uint8 or len(page.shape) != 3 \
+            or page.shape[2] != 3 \
+            or page.photometric != tifffile.PHOTOMETRIC.RGB \
+            or page.compression not in tifffile.TIFF.DECOMPRESSORS \
+            or (orientation is not None and orientation.value != 1):
+            return None
+        rgb = page.asarray()
+
+    return rgb[..., ::-1]
+
+
+def read_image(image_path, img_format, detection=True):
+
+    '''
+    Read in 8 bit image once. RAW files are opened and unpacked a single time
+    and the same LibRaw handle is postprocessed (1) for color correction with
+    no auto brightness, no WB adjustment and (2) for color card detection at
+    half resolution (unless the embedded JPEG preview is used, see
+    read_preview()) using camera WB, auto brightness and autoscaling. Both use
+    no 4-channel-RGB and no gamma supression. TIFF/PNG images are used as they
+    are for both. Images for detection are downscaled to DETECT_MAX_SIZE (long
+    edge). Return both images as BGR (the first one is None if
+    detection=False).
+    '''
+
+    # read RAW (rawpy is only imported for RAW images)
+    if img_format in RAW_SUFFIX_SET:
+        import rawpy
+
+        # read RAW
+        with rawpy.imread(image_path) as raw:
+
+            # convert to RGB for color correction
+            rgb = raw.postprocess(
+                output_color=rawpy.ColorSpace.sRGB,
+                **POSTPROCESS_KWARGS_CORRECT,
+            )
+
+            # use embedded preview or convert to RGB for card detection
+            bgr_detect = None
+            if detection and DETECT_ON_PREVIEW:
+                bgr_detect = read_preview(raw, rgb.shape)
+            if detection and bgr_detect is None:
+                bgr_detect = raw.postprocess(
+                    output_color=rawpy.ColorSpace.sRGB,
+                    **POSTPROCESS_KWARGS_DETECT,
+                )[..., ::-1]
+
+        # rearrange channels because plantcv expects BGR (reversed channel
+        # views, no copy)
+        bgr = rgb[..., ::-1]
+
+    # read TIFF/PNG
+    elif img_format in TIF_PNG_SUFFIX_SET:
+
+        # read 8 bit RGB TIFFs with tifffile
+        bgr = None
+        if img_format.lower() in ('tif', 'tiff'):
+            bgr = read_tiff(image_path)
+
+        # else read file in one go and decode from memory
+        if bgr is None:
+            with open(image_path, 'rb', buffering=0) as f:
+                buf = f.read()
+            bgr = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+        bgr_detect = bgr if detection else None
+
+    # else print error message and exit
+    else:
+        print(
+            '[ERROR] images must be either in a RAW, TIFF or PNG format',
+             file=sys.stderr,
+        )
+        sys.exit()
+
+    # downscale image for card detection (area averaging)
+    if detection and max(bgr_detect.shape[:2]) > DETECT_MAX_SIZE:
+        scale = DETECT_MAX_SIZE / max(bgr_detect.shape[:2])
+        bgr_detect = cv2.resize(
+            bgr_detect,
+            None,
+            fx=scale,
+            fy=scale,
+            interpolation=cv2.INTER_AREA,
+        )
+
+    return bgr_detect, bgr
+
+
+def read_raw_detection_full(image_path):
+
+    '''
+    Postprocess a RAW image at full resolution with the color card detection
+    settings (POSTPROCESS_KWARGS_DETECT without half_size), for retrying
+    detection at full resolution. Return BGR image (reversed channel view).
+    '''
+
+    import rawpy
+
+    with rawpy.imread(image_path) as raw:
+        rgb = raw.postprocess(
+            output_color=rawpy.ColorSpace.sRGB,
+            **dict(POSTPROCESS_KWARGS_DETECT, half_size=False),
+        )
+
+    return rgb[..., ::-1]
+
+
+def write_cache_file(cache_path, save_fn, *args, **kwargs):
+
+    '''
+    Write a cache file with a NumPy save function (np.save(),
+    np.savez_compressed()) atomically: write to a temporary file in the same
+    directory and rename it into place, so that other processes never read a
+    partially written file. Caching is optional, so if the cache directory
+    cannot be written, print a warning and continue.
+    '''
+
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            save_fn(f, *args, **kwargs)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f'[WARNING] Could not write cache file ({e})', file=sys.stderr)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_cache_file(cache_path, key=None):
+
+    '''
+    Read a cache file written with write_cache_file() (the array stored as
+    key in .npz files). Return None if it does not exist or cannot be read,
+    so that the caller derives the data again.
+    '''
+
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = np.load(f)
+            return cache if key is None else cache[key]
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile, zlib.error) \
+            as e:
+        print(
+            f'[WARNING] Ignoring unreadable cache file {cache_path} ({e})',
+            file=sys.stderr,
+        )
+        return None
+
+
+def detect_color_card(bgr_detect, bgr, label, ADAPTIVE_METHOD, BLOCK_SIZE, \
+        RADIUS, MIN_SIZE, review=True, cache_path=None, image_path=None, \
+        img_format=None):
+
+    '''
+    Detect color card in the BGR image read in for detection by read_image(),
+    which may have a lower resolution than the BGR image used for color
+    correction: scale detection parameters accordingly and scale the mask up
+    to the resolution of the latter. If no color card is found at lower
+    resolution, retry at full resolution: RAW images (image_path and
+    img_format given) are postprocessed again at full size with the
+    detection settings, otherwise the image used for color correction is
+    searched (TIFF/PNG images are the same for both). If review is set, let
+    PlantCV write a PNG with the masked color card. If cache_path is given,
+    load the mask from there instead of detecting the color card (no review
+    PNG is written then) or save it there (at detection resolution). Return
+    color card mask.
+    '''
+
+    # load cached mask
+    card_mask = None
+    if cache_path is not None:
+        card_mask = read_cache_file(cache_path, 'card_mask')
+
+    # else detect color card
+    if card_mask is None:
+
+        # enable debug/print only for review (PNG encoding is expensive)
+        pcv.params.debug = 'print' if review else None
+
+        # scale pixel-based parameters to detection resolution (block size
+        # must stay uneven)
+        scale = bgr_detect.shape[0] / bgr.shape[0]
+
+        # detect color card
+        try:
+            card_mask = pcv.transform.detect_color_card(
+                rgb_img=bgr_detect,
+                label=label,
+                adaptive_method=ADAPTIVE_METHOD,
+                block_size=int(BLOCK_SIZE * scale) // 2 * 2 + 1,
+                radius=max(1, round(RADIUS * scale)),
+                min_size=MIN_SIZE * scale ** 2,
+                )
+        except RuntimeError:
+            if scale == 1:
+                raise
+            print(
+                f'[INFO] {label}: No color card found at reduced resolution, '
+                 'retrying at full resolution',
+                 file=sys.stderr,
+            )
+            bgr_full = bgr
+            if image_path is not None and img_format in RAW_SUFFIX_SET:
+                bgr_full = read_raw_detection_full(image_path)
+            return detect_color_card(bgr_full, bgr, label, ADAPTIVE_METHOD, \
+                BLOCK_SIZE, RADIUS, MIN_SIZE, review, cache_path)
+
+        # PlantCV returns a float64 mask, but chip labels (multiples of 10 up
+        # to 240) fit into uint8, which is 8x smaller to upscale and scan
+        card_mask = card_mask.astype(np.uint8)
+
+        # cache mask
+        if cache_path is not None:
+            write_cache_file(
+                cache_path,
+                np.savez_compressed,
+                card_mask=card_mask,
+            )
+
+    # scale mask up to full resolution
+    if card_mask.shape != bgr.shape[:2]:
+        card_mask = cv2.resize(
+            card_mask,
+            (bgr.shape[1], bgr.shape[0]),
+            interpolation=cv2.INTER_NEAREST,
+        )
+
+    return card_mask
+
+
+def extract_color_matrix(bgr, card_mask):
+
+    '''
+    Derive color card matrix from a BGR uint8 image like PlantCV's
+    get_color_matrix() (one row per chip in ascending order of chip numbers;
+    columns: chip number, mean R, G, B intensities in [0-1]) from a uint8
+    card_mask, but only gather the pixels covered by card_mask instead of
+    converting the entire image to float. The matrix is returned as float32.
+    '''
+
+    # gather masked pixels, count pixels per chip label (uint8 labels index
+    # the counts directly, no sorting)
+    idx = np.nonzero(card_mask)
+    label_arr = card_mask[idx]
+    chip_size_arr = np.bincount(label_arr)
+    chip_arr = np.flatnonzero(chip_size_arr)
+    chip_size_arr = chip_size_arr[chip_arr]
+    pixel_arr = bgr[idx]
+
+    # average each channel per chip (BGR channels to RGB columns)
+    color_matrix = np.empty((len(chip_arr), 4), np.float32)
+    color_matrix[:, 0] = chip_arr
+    for c in range(3):
+        color_matrix[:, 3 - c] = np.bincount(
+            label_arr,
+            weights=pixel_arr[:, c],
+        )[chip_arr] / chip_size_arr / 255
+
+    return color_matrix
+
+
+def get_ref_color_matrix(bgr_detect, bgr, ref_path, img_format, \
+        ADAPTIVE_METHOD, BLOCK_SIZE, RADIUS, MIN_SIZE, review=True):
+
+    '''
+    Extract reference color matrix from a RAW/PNG/TIFF image read in with
+    read_image(): detect color card with detect_color_card() and extract
+    color matrix.
+    '''
+
+    # get color profile from reference image
+    ref_card_mask = detect_color_card(
+        bgr_detect,
+        bgr,
+        os.path.basename(ref_path).split('_', 1)[0],
+        ADAPTIVE_METHOD,
+        BLOCK_SIZE,
+        RADIUS,
+        MIN_SIZE,
+        review,
+        image_path=ref_path,
+        img_format=img_format,
+    )
+
+    # disable debug/print
+    pcv.params.debug = None
+
+    # derive color card matrix
+    ref_color_matrix = extract_color_matrix(bgr, ref_card_mask)
+
+    return ref_color_matrix
+
+
+def get_cache_dir_path():
+
+    '''
+    Return path of the cache directory ($XDG_CACHE_HOME/color_correction or
+    ~/.cache/color_correction).
+    '''
+
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'color_correction',
+    )
+
+
+def get_ref_cache_path(ref_path, ADAPTIVE_METHOD, BLOCK_SIZE, RADIUS, \
+        MIN_SIZE):
+
+    '''
+    Return path of the cached reference color matrix derived from a reference
+    image (in the cache directory, see get_cache_dir_path()). The file name is
+    the SHA-1 hash of the image contents, of the card detection parameters and
+    RAW postprocessing settings and of CACHE_VERSION, so any change to either
+    invalidates the cache.
+    '''
+
+    # hash image in 1 MB chunks
+    sha1 = hashlib.sha1()
+    with open(ref_path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            sha1.update(chunk)
+
+    # hash settings
+    sha1.update(repr((
+        CACHE_VERSION,
+        ADAPTIVE_METHOD,
+        BLOCK_SIZE,
+        RADIUS,
+        MIN_SIZE,
+        POSTPROCESS_KWARGS_DETECT,
+        POSTPROCESS_KWARGS_CORRECT,
+        DETECT_ON_PREVIEW,
+        DETECT_MAX_SIZE,
+    )).encode())
+
+    return f'{get_cache_dir_path()}/{sha1.hexdigest()}.npy'
+
+
+def get_mask_cache_path(image_path, ADAPTIVE_METHOD, BLOCK_SIZE, RADIUS, \
+        MIN_SIZE):
+
+    '''
+    Return path of the cached color card mask of an image (in the masks
+    subdirectory of the cache directory). The file name is the SHA-1 hash of
+    the absolute path, size and modification time of the image, of the card
+    detection settings and of CACHE_VERSION, so changing either invalidates
+    the cache.
+    '''
+
+    stat = os.stat(image_path)
+    sha1 = hashlib.sha1(repr((
+        os.path.abspath(image_path),
+        stat.st_size,
+        stat.st_mtime_ns,
+        CACHE_VERSION,
+        ADAPTIVE_METHOD,
+        BLOCK_SIZE,
+        RADIUS,
+        MIN_SIZE,
+        POSTPROCESS_KWARGS_DETECT,
+        DETECT_ON_PREVIEW,
+        DETECT_MAX_SIZE,
+    )).encode())
+
+    return f'{get_cache_dir_path()}/masks/{sha1.hexdigest()}.npz'
+
+
+def read_ref_color_matrix(ref_path):
+
+    '''
+    Read in previously extracted reference color matrix
+    '''
+
+    ref_color_matrix = np.loadtxt(
+        ref_path,
+        delimiter='\t'
+    )
+
+    return ref_color_matrix
+
+
+def save_image(rgb_corr, output_path, icc_profile):
+
+    '''
+    Save color-corrected RGB image as TIFF with embedded ICC color profile.
+    '''
+
+    # write array directly (tag 34675: ICC profile)
+    tifffile.imwrite(
+        output_path,
+        rgb_corr,
+        photometric='rgb',
+        compression=TIFF_COMPRESSION,
+        compressionargs={'level': TIFF_COMPRESSION_LEVEL},
+        tile=(TIFF_TILE_SIZE, TIFF_TILE_SIZE),
+        extratags=[(34675, 7, len(icc_profile), icc_profile, True)],
+    )
@@ -20,8 +20,15 @@ ADAPTIVE_METHOD = 0
 BLOCK_SIZE = 101
 RADIUS = 50
 MIN_SIZE = 20000
-RAW_SUFFIX_LST = ['RAW', 'raw', 'ARW', 'arw', 'NEF', 'nef']
-TIF_PNG_SUFFIX_LST = ['TIFF', 'tiff', 'TIF', 'tif', 'PNG', 'png']
+
+# (image decoding, detection resolution, caching and TIFF output settings are
+# shared by all scripts and set in color_correct_utils.py)
+
+# default number of worker processes with --batch_tsv (number of CPU cores,
+# but at most this many): every worker holds a proxy and a target image (of
+# 24 MP: about 0.5 GB per worker, 1 GB without numba, see README), and the
+# numba kernels of fewer workers still use all cores
+MAX_DEFAULT_PROCESSES = 4
 
 
 ## SETUP
@@ -30,6 +37,8 @@ TIF_PNG_SUFFIX_LST = ['TIFF', 'tiff', 'TIF', 'tif', 'PNG', 'png']
 import argparse
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 
 
@@ -38,296 +47,355 @@ import sys
 def cli():
 
     '''
-    Parse command line arguments.
+    Parse and return command line arguments.
     '''
 
-    global target_image_path, proxy_image_path, ref_path, ref_path, \
-        output_path, review_dir_path, img_format, icc_profile_path
-
     parser = argparse.ArgumentParser(description="Infer color corrections \
         from proxy image, apply them to target image.")
 
     # add arguments
-    parser.add_argument('target_image_path', type=str, help='Path to the RAW \
-        (or PNG/TIFF) image to apply corrections to')
-    parser.add_argument('proxy_image_path', type=str, help='Path to a \
-        "proxy" RAW (or PNG/TIFF) image used to infer corrections from')
+    parser.add_argument('target_image_path', type=str, nargs='?', help='Path \
+        to the RAW (or PNG/TIFF) image to apply corrections to (omit with \
+        --batch_tsv)')
+    parser.add_argument('proxy_image_path', type=str, nargs='?', help='Path \
+        to a "proxy" RAW (or PNG/TIFF) image used to infer corrections from \
+        (omit with --batch_tsv)')
     parser.add_argument('ref_path', type=str, help='Path to the RAW \
         (or PNG/TIFF) image serving as the reference for for color correction \
         (or previously extracted reference color matrix in TSV format)')
     parser.add_argument('output_path', type=str, help='Path to the \
-        color-corrected output TIFF')
+        color-corrected output TIFF (output directory with --batch_tsv)')
     parser.add_argument('review_dir_path', type=str, help='Path to the PlantCV \
         debug directory which will contain PNGs with the masked color card for \
-        review')
+        review (only written with --review)')
     parser.add_argument('img_format', type=str, help='Image format, this \
         could be "ARW" (Sony), "NEF" (Nikon), "CR3" (Canon) or others \
         (check rawpy) – PNG and TIFF formats are also supported')
     parser.add_argument('icc_profile_path', type=str, help='Path to the ICC \
         color profile to be embedded in the output TIFFs, for example the \
         supplied sRGB profile: data/sRGB_profile.icc')
+    parser.add_argument('--review', action=argparse.BooleanOptionalAction,
+        default=False, help='Write PNGs with the masked color card to \
+        <review_dir_path> (default: off)')
+    parser.add_argument('--batch_tsv', type=str, default=None, help='Path to \
+        a TSV file listing one target and one proxy image path per line: \
+        correct all target images against the same reference in one run and \
+        save them to <output_path> as <target image name>.tiff (target image \
+        names must be unique)')
+    parser.add_argument('-p', '--processes', type=int,
+        default=min(MAX_DEFAULT_PROCESSES, os.cpu_count()), help='With \
+        --batch_tsv, number of images to process in parallel; each process \
+        needs about 0.5 GB of memory for 24 MP images (1 GB without numba) \
+        (default: number of CPU cores, at most 4)')
+    parser.add_argument('--cache_ref', action=argparse.BooleanOptionalAction,
+        default=True, help='Cache the reference color matrix extracted from \
+        <ref_path> in ~/.cache/color_correction (shared with batch_correct.py) \
+        and reuse it while the image and the detection settings are unchanged \
+        (default: on)')
+    parser.add_argument('--cache_masks', action=argparse.BooleanOptionalAction,
+        default=False, help='Cache color card masks of proxy images in \
+        ~/.cache/color_correction/masks and reuse them for unchanged images \
+        on re-runs (default: off)')
 
     # parse
     args = parser.parse_args()
 
-    # reassign variable names
-    target_image_path, proxy_image_path, ref_path, output_path, \
-        review_dir_path, img_format, icc_profile_path = \
-        args.target_image_path, args.proxy_image_path, args.ref_path, \
-        args.output_path, args.review_dir_path, args.img_format, \
-        args.icc_profile_path
+    # target and proxy image are read from the batch TSV if specified
+    if (args.batch_tsv is None) != (args.proxy_image_path is not None):
+        parser.error('specify either <target_image_path> and '
+            '<proxy_image_path> or --batch_tsv')
+
+    return args
 
 
 
 ## FUNCTIONS
 
-def check_make_dir(dir_path):
+def import_packages():
 
     '''
-    Check if a directory exists, if not, create it.
+    Import remaining packages into the module namespace (deferred until after
+    argument parsing, including the shared helpers in color_correct_utils.py).
     '''
 
-    if not os.path.isdir(dir_path):
-        os.mkdir(dir_path)
-
-
-def detect_color_card(image_path, img_format, ADAPTIVE_METHOD, BLOCK_SIZE, \
-        RADIUS, MIN_SIZE, RAW_SUFFIX_LST, TIF_PNG_SUFFIX_LST):
-
-    '''
-    Read in 8 bit image using auto brightness, autoscaling, no 4-channel-RGB,
-    no gamma supression. Return color card mask.
-    '''
+    global pcv, np, utils, kernels
 
-    # enable debug/print
-    pcv.params.debug = 'print'
+    from plantcv import plantcv as pcv
+    import numpy as np
+    import color_correct_utils as utils
 
-    # read RAW
-    if img_format in RAW_SUFFIX_LST:
+    # numba-compiled kernels are optional (fall back to NumPy)
+    try:
+        import color_correct_kernels as kernels
+    except ImportError:
+        kernels = None
 
-        # read RAW
-        raw = rawpy.imread(image_path)
 
-        # convert to RGB
-        rgb = raw.postprocess(
-            output_bps=8,
-            no_auto_bright=False,
-            use_camera_wb=False,
-            use_auto_wb=True,
-            no_auto_scale=False,
-            four_color_rgb=False,
-            output_color=rawpy.ColorSpace.sRGB,
-        )
+def init_worker(review_dir_path, n_threads):
 
-        # rearrange channels because plantcv expects BGR
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    '''
+    Set up a worker process: import packages and point PlantCV to the review
+    directory (workers do not inherit either from the main process unless
+    they are forked) and limit the numba kernels to n_threads threads (so
+    that the workers together do not oversubscribe the CPU in batch mode).
+    '''
 
-    # read TIFF/PNG
-    elif img_format in TIF_PNG_SUFFIX_LST:
+    import_packages()
+    pcv.params.debug_outdir = review_dir_path
+    if kernels is not None:
+        kernels.set_threads(n_threads)
 
-        bgr = cv2.imread(image_path, cv2.IMREAD_COLOR)
 
-    # else print error message and exit
-    else:
-        print(
-            '[ERROR] images must be either in a RAW, TIFF or PNG format',
-             file=sys.stderr,
-        )
-        sys.exit()
+def swap_channels(img_tpl):
 
-    # detect color card
-    card_mask = pcv.transform.detect_color_card(
-        rgb_img=bgr,
-        label=image_path.split('/')[-1].split('_')[0],
-        adaptive_method=ADAPTIVE_METHOD,
-        block_size=BLOCK_SIZE,
-        radius=RADIUS,
-        min_size=MIN_SIZE,
-        )
+    '''
+    Reverse the channel order (BGR <-> RGB) of all images in a tuple returned
+    by read_image() without copying them (None entries are kept).
+    '''
 
-    return card_mask
+    return tuple(None if img is None else img[..., ::-1] for img in img_tpl)
 
 
-def get_ref_color_matrix(ref_path, img_format, ADAPTIVE_METHOD, BLOCK_SIZE, \
-        RADIUS, MIN_SIZE, RAW_SUFFIX_LST, TIF_PNG_SUFFIX_LST):
+def read_image_in_worker(image_path, img_format, detection=True):
 
     '''
-    Extract reference color matrix from a RAW/PNG/TIFF image: First detect
-    color card with detect_color_card(), then read it in again as in
-    apply_color_correction() and extract color mask.
+    Run read_image() in a worker process. The BGR images of RAW files are
+    reversed channel views, which would be copied when sent back to the main
+    process, so return the underlying contiguous RGB images instead (swap
+    channels again with swap_channels() after receiving them).
     '''
 
-    # enable debug/print
-    pcv.params.debug = 'print'
+    img_tpl = utils.read_image(image_path, img_format, detection=detection)
 
-    # get color profile from reference image
-    ref_card_mask = detect_color_card(
-        ref_path,
-        img_format,
-        ADAPTIVE_METHOD,
-        BLOCK_SIZE,
-        RADIUS,
-        MIN_SIZE,
-        RAW_SUFFIX_LST,
-        TIF_PNG_SUFFIX_LST,
-    )
+    if img_format in utils.RAW_SUFFIX_SET:
+        img_tpl = swap_channels(img_tpl)
 
-    # disable debug/print
-    pcv.params.debug = None
+    return img_tpl
 
 
-    # read RAW
-    if img_format in RAW_SUFFIX_LST:
+def receive_image(future, img_format):
 
-        # read RAW
-        raw = rawpy.imread(ref_path)
+    '''
+    Fetch images read in by read_image_in_worker() from a future and restore
+    BGR channel order for RAW files (no copy).
+    '''
 
-        # convert to RGB
-        rgb = raw.postprocess(
-            output_bps=8,
-            no_auto_bright=True,
-            use_camera_wb=False,
-            use_auto_wb=False,
-            no_auto_scale=False,
-            four_color_rgb=False,
-            output_color=rawpy.ColorSpace.sRGB,
-        )
+    img_tpl = future.result()
 
-        # rearrange channels because plantcv expects BGR
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    if img_format in utils.RAW_SUFFIX_SET:
+        img_tpl = swap_channels(img_tpl)
 
-    # read TIFF/PNG
-    else:
+    return img_tpl
 
-        bgr = cv2.imread(ref_path, cv2.IMREAD_COLOR)
 
-    # derive color card matrix
-    _, ref_color_matrix = pcv.transform.get_color_matrix(
-        rgb_img=bgr,
-        mask=ref_card_mask
-    )
+def affine_color_correction(bgr, source_matrix, target_matrix):
 
-    return ref_color_matrix
+    '''
+    Replacement for PlantCV's affine_color_correction(): fit affine
+    transformation from source to target color matrix (columns: chip number,
+    R, G, B) by least squares in the same way, but apply it to the image in
+    float32 with a single matrix multiplication. The BGR to RGB conversion is
+    folded into the transformation matrix. Return color-corrected RGB image
+    (raise a RuntimeError like PlantCV if the matrices differ in shape).
+    '''
 
+    # matrices must have the same number of color references
+    if source_matrix.shape != target_matrix.shape:
+        raise RuntimeError("Mismatch between the color matrices' shapes")
 
-def read_ref_color_matrix(ref_path):
+    # fit transformation (rows: R, G, B, constant), bias in [0-255] units;
+    # the pseudo-inverse is that of the source (proxy) matrix, which differs
+    # between images, so nothing can be precomputed for the fixed reference
+    s = np.column_stack((source_matrix[:, 1:], np.ones(len(source_matrix))))
+    coef = np.linalg.pinv(s) @ target_matrix[:, 1:]
+    bias = (255 * coef[3]).astype(np.float32)
 
-    '''
-    Read in previously extracted reference color matrix
-    '''
+    # reverse matrix rows to map BGR input to RGB output
+    m = coef[2::-1].astype(np.float32)
 
-    ref_color_matrix = np.loadtxt(
-        ref_path,
-        delimiter='\t'
-    )
+    # transform all pixels at once, clip, truncate like PlantCV
+    bgr_flat = bgr.astype(np.float32).reshape(-1, 3)
+    rgb_corr_flat = bgr_flat @ m
+    rgb_corr_flat += bias
+    np.clip(rgb_corr_flat, 0, 255, out=rgb_corr_flat)
+    rgb_corr = rgb_corr_flat.astype(np.uint8).reshape(bgr.shape)
 
-    return ref_color_matrix
+    return rgb_corr
 
 
-def proxy_correct(proxy_image_path, target_image_path, ref_color_matrix):
+def proxy_correct(bgr_detect, bgr, target_bgr, proxy_image_path, \
+        img_format, ref_color_matrix, review=True, cache_masks=False):
 
     '''
-    Fetch color matrix from proxy image, apply corrections to taget image.
+    Fetch color matrix from proxy image, apply corrections to taget image
+    (all images read in with read_image()). If review is set, let PlantCV
+    write a PNG with the masked color card. If cache_masks is set, reuse or
+    store the color card mask of the proxy image (see get_mask_cache_path()).
     '''
 
     # detect color card
-    card_mask = detect_color_card(
+    mask_cache_path = utils.get_mask_cache_path(
         proxy_image_path,
-        img_format,
         ADAPTIVE_METHOD,
         BLOCK_SIZE,
         RADIUS,
         MIN_SIZE,
-        RAW_SUFFIX_LST,
-        TIF_PNG_SUFFIX_LST,
+    ) if cache_masks else None
+    card_mask = utils.detect_color_card(
+        bgr_detect,
+        bgr,
+        os.path.basename(proxy_image_path).split('_', 1)[0],
+        ADAPTIVE_METHOD,
+        BLOCK_SIZE,
+        RADIUS,
+        MIN_SIZE,
+        review,
+        mask_cache_path,
+        proxy_image_path,
+        img_format,
     )
 
     # disable debug/print
     pcv.params.debug = None
 
-    # read RAW
-    if img_format in RAW_SUFFIX_LST:
-
-        # read RAW (good image)
-        raw = rawpy.imread(proxy_image_path)
-
-        # convert to RGB
-        rgb = raw.postprocess(
-            output_bps=8,
-            no_auto_bright=True,
-            use_camera_wb=False,
-            use_auto_wb=False,
-            no_auto_scale=False,
-            four_color_rgb=True,
-            output_color=rawpy.ColorSpace.sRGB,
+    # derive color card matrix
+    color_matrix = utils.extract_color_matrix(bgr, card_mask)
+
+    # the comparison below requires matrices of the same shape
+    if color_matrix.shape != ref_color_matrix.shape:
+        raise RuntimeError(
+            f'{proxy_image_path}: Color matrix shape {color_matrix.shape} '
+            f'does not match reference color matrix shape '
+            f'{ref_color_matrix.shape}'
         )
 
-        # rearrange channels because plantcv expects BGR
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    # derive upside-down color card matrix: rotating the card by 180°
+    # reverses the order of the chips, so reverse the color rows (but keep
+    # the chip numbers) instead of scanning the image again
+    color_matrix_ud = np.column_stack(
+        (color_matrix[:, 0], color_matrix[::-1, 1:])
+    )
 
-    # read TIFF/PNG
+    # compute “distance” to reference matrix (sum of squared differences)
+    # and select correct orientation
+    if kernels is not None:
+        upside_down = kernels.compare_matrices(
+            color_matrix,
+            color_matrix_ud,
+            ref_color_matrix,
+        )
     else:
+        diff = np.stack((color_matrix, color_matrix_ud)) - ref_color_matrix
+        diff_normal, diff_flipped = np.einsum('ijk,ijk->i', diff, diff)
+        upside_down = diff_normal >= diff_flipped
+    if upside_down:
+        print('[INFO] Color card upside down', file=sys.stderr)
+        color_matrix = color_matrix_ud
 
-        bgr = cv2.imread(proxy_image_path, cv2.IMREAD_COLOR)
+    # correct colors (returns RGB)
+    if kernels is not None:
+        rgb_corr = kernels.affine_color_correction(
+            target_bgr,
+            color_matrix,
+            ref_color_matrix,
+            rgb=True,
+        )
+    else:
+        rgb_corr = affine_color_correction(
+            target_bgr,
+            color_matrix,
+            ref_color_matrix,
+        )
 
-    # derive color card matrix
-    _, color_matrix = pcv.transform.get_color_matrix(
-        rgb_img=bgr,
-        mask=card_mask
-    )
+    return rgb_corr
 
-    # derive upside-down color card matrix
-    card_mask_ud = np.flipud(card_mask)
-    _, color_matrix_ud = pcv.transform.get_color_matrix(
-        rgb_img=bgr,
-        mask=card_mask_ud
-    )
 
-    # compute “distance” to reference matrix (sum of squared differences)
-    diff_normal = np.linalg.norm(color_matrix - ref_color_matrix)
-    diff_flipped = np.linalg.norm(color_matrix_ud - ref_color_matrix)
+def get_out_image(target_image_path):
 
-    # select correct orientation
-    if diff_normal >= diff_flipped:
-        print('[INFO] Color card upside down', file=sys.stderr)
-        color_matrix = color_matrix_ud
+    '''
+    Return file name of the output TIFF of a target image in batch mode.
+    '''
 
-    # read RAW
-    if img_format in RAW_SUFFIX_LST:
-
-        # read RAW (bad image)
-        raw = rawpy.imread(target_image_path)
-
-        # convert to RGB
-        rgb = raw.postprocess(
-            output_bps=8,
-            no_auto_bright=True,
-            use_camera_wb=False,
-            use_auto_wb=False,
-            no_auto_scale=False,
-            four_color_rgb=True,
-            output_color=rawpy.ColorSpace.sRGB,
-        )
+    return f'{os.path.splitext(os.path.basename(target_image_path))[0]}.tiff'
 
-        # rearrange channels because plantcv expects BGR
-        bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
 
-    # read TIFF/PNG
-    else:
+def read_batch_tsv(batch_tsv_path):
+
+    '''
+    Read (target image path, proxy image path) tuples from batch TSV (empty
+    lines are skipped). Outputs are named after the target images, so exit if
+    two target images (e.g. in different directories) share a name.
+    '''
+
+    pair_lst = []
+    out_image_dct = {}
+    with open(batch_tsv_path) as batch_tsv:
+        for line in batch_tsv:
+            if not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 2:
+                print(
+                    f'[ERROR] {batch_tsv_path}: expected two tab-separated '
+                    f'columns (target and proxy image path): {line!r}',
+                     file=sys.stderr,
+                )
+                sys.exit()
+            out_image = get_out_image(fields[0])
+            if out_image in out_image_dct:
+                print(
+                    f'[ERROR] {batch_tsv_path}: target images '
+                    f'{out_image_dct[out_image]} and {fields[0]} would both '
+                    f'be saved as {out_image}',
+                     file=sys.stderr,
+                )
+                sys.exit()
+            out_image_dct[out_image] = fields[0]
+            pair_lst.append(tuple(fields))
+
+    return pair_lst
+
+
+def correct_pair(idx, pair, output_dir_path, ref_color_matrix, icc_profile, \
+        img_format, review, cache_masks):
+
+    '''
+    Read in target and proxy image of a pair from the batch TSV, correct the
+    target image with proxy_correct() and save it to output_dir_path (runs
+    in a worker process). Return output path.
+    '''
+
+    target_image_path, proxy_image_path = pair
 
-        bgr = cv2.imread(target_image_path, cv2.IMREAD_COLOR)
+    # number review PNGs by pair in the batch TSV (the reference is 0)
+    pcv.params.device = idx + 1
 
-    # correct colors
-    bgr_corr = pcv.transform.affine_color_correction(
-        rgb_img=bgr,
-        source_matrix=color_matrix,
-        target_matrix=ref_color_matrix
+    # read proxy image and target image unless it is the proxy image itself
+    bgr_detect, bgr = utils.read_image(proxy_image_path, img_format)
+    if os.path.samefile(target_image_path, proxy_image_path):
+        target_bgr = bgr
+    else:
+        _, target_bgr = utils.read_image(
+            target_image_path, img_format, detection=False,
+        )
+
+    # apply proxy corrections
+    rgb_corr = proxy_correct(
+        bgr_detect,
+        bgr,
+        target_bgr,
+        proxy_image_path,
+        img_format,
+        ref_color_matrix,
+        review,
+        cache_masks,
     )
 
-    # convert back to RGB
-    rgb_corr = cv2.cvtColor(bgr_corr, cv2.COLOR_BGR2RGB)
+    # save
+    output_path = f'{output_dir_path}/{get_out_image(target_image_path)}'
+    utils.save_image(rgb_corr, output_path, icc_profile)
 
-    return rgb_corr
+    return output_path
 
 
 
@@ -336,65 +404,167 @@ def proxy_correct(proxy_image_path, target_image_path, ref_color_matrix):
 def main():
 
     # parse arguments
-    cli()
+    args = cli()
 
     # import remaining packages
-    import rawpy
-    import cv2
-    from plantcv import plantcv as pcv
-    from PIL import Image
-    import numpy as np
+    import_packages()
 
     # make directories if they don't exist
-    check_make_dir(review_dir_path)
+    if args.review:
+        utils.check_make_dir(args.review_dir_path)
+    if args.batch_tsv is not None:
+        utils.check_make_dir(args.output_path)
 
     # set up PlantCV (i.e. set debugging directory )
-    pcv.params.debug_outdir = review_dir_path
+    pcv.params.debug_outdir = args.review_dir_path
 
     # read ICC color profile
-    with open(icc_profile_path, "rb") as f:
+    with open(args.icc_profile_path, "rb") as f:
         icc_profile = f.read()
 
-    # extract reference/target color mask
-    if img_format in RAW_SUFFIX_LST + TIF_PNG_SUFFIX_LST \
-        and ref_path.lower().endswith(img_format.lower()):
-        ref_color_matrix = get_ref_color_matrix(
-            ref_path,
-            img_format,
+    # check reference format
+    suffix = args.img_format.lower()
+    ref_is_image = args.img_format in \
+        utils.RAW_SUFFIX_SET | utils.TIF_PNG_SUFFIX_SET \
+        and args.ref_path.lower().endswith(suffix)
+    if not ref_is_image and not args.ref_path.endswith('.tsv'):
+        print(
+            f'[ERROR] <ref_path> must be either in {args.img_format} or .tsv'
+             ' format',
+             file=sys.stderr,
+        )
+        sys.exit()
+
+    # load reference color matrix from TSV or from the cache (shared with
+    # batch_correct.py), else extract it from the reference image below
+    ref_color_matrix = None
+    if not ref_is_image:
+        ref_color_matrix = utils.read_ref_color_matrix(
+            args.ref_path,
+        )
+    elif args.cache_ref:
+        ref_cache_path = utils.get_ref_cache_path(
+            args.ref_path,
             ADAPTIVE_METHOD,
             BLOCK_SIZE,
             RADIUS,
             MIN_SIZE,
-            RAW_SUFFIX_LST,
-            TIF_PNG_SUFFIX_LST,
         )
-    elif ref_path.endswith('.tsv'):
-        ref_color_matrix = read_ref_color_matrix(
-            ref_path,
+        ref_color_matrix = utils.read_cache_file(ref_cache_path)
+        if ref_color_matrix is not None:
+            print(
+                f'[INFO] {args.ref_path}: Using cached reference color matrix '
+                f'({ref_cache_path})',
+                file=sys.stderr,
+            )
+    extract_ref = ref_color_matrix is None
+
+    # decode reference, proxy and target images in parallel (RAW
+    # postprocessing is single-threaded); the target image is only read if it
+    # is not the proxy image itself (no card detection required); in batch
+    # mode, all pairs are processed in parallel once the reference color
+    # matrix is available
+    if args.batch_tsv is None:
+        target_is_proxy = os.path.samefile(
+            args.target_image_path,
+            args.proxy_image_path,
         )
+        n_workers = 3
     else:
-        print(
-            f'[ERROR] <ref_path> must be either in {img_format} or .tsv'
-             ' format',
-             file=sys.stderr,
+        pair_lst = read_batch_tsv(args.batch_tsv)
+        n_workers = max(1, min(args.processes, len(pair_lst)))
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_worker,
+        initargs=(
+            args.review_dir_path,
+            os.cpu_count() // n_workers,
+        ),
+    ) as executor:
+        if extract_ref:
+            ref_future = executor.submit(
+                read_image_in_worker, args.ref_path, args.img_format,
+            )
+        if args.batch_tsv is None:
+            proxy_future = executor.submit(
+                read_image_in_worker, args.proxy_image_path, args.img_format,
+            )
+            if not target_is_proxy:
+                target_future = executor.submit(
+                    read_image_in_worker, args.target_image_path,
+                    args.img_format, detection=False,
+                )
+
+        # compile numba kernels in a worker while the images are decoded, so
+        # that the correction (in this process or, in batch mode, in the
+        # workers) loads them from the on-disk cache; this process must not
+        # load numba's threading layer before the workers are forked
+        if kernels is not None:
+            warm_up_future = executor.submit(kernels.warm_up)
+
+        # extract and cache reference color matrix (while proxy and target
+        # images are still being decoded)
+        if extract_ref:
+            ref_color_matrix = utils.get_ref_color_matrix(
+                *receive_image(ref_future, args.img_format),
+                args.ref_path,
+                args.img_format,
+                ADAPTIVE_METHOD,
+                BLOCK_SIZE,
+                RADIUS,
+                MIN_SIZE,
+                args.review,
+            )
+            if args.cache_ref:
+                utils.write_cache_file(
+                    ref_cache_path,
+                    np.save,
+                    ref_color_matrix,
+                )
+
+        # keep color matrices in float32 (like the matrices of proxy images)
+        ref_color_matrix = ref_color_matrix.astype(np.float32)
+
+        # batch mode: correct and save all pairs
+        if args.batch_tsv is not None:
+            correct_fn = partial(
+                correct_pair,
+                output_dir_path=args.output_path,
+                ref_color_matrix=ref_color_matrix,
+                icc_profile=icc_profile,
+                img_format=args.img_format,
+                review=args.review,
+                cache_masks=args.cache_masks,
+            )
+            if kernels is not None:
+                warm_up_future.result()
+            for out_path in executor.map(
+                    correct_fn, range(len(pair_lst)), pair_lst):
+                print(f'[INFO] Saved {out_path}', file=sys.stderr)
+            return
+
+        # collect proxy and target images
+        proxy_bgr_detect, proxy_bgr = receive_image(
+            proxy_future,
+            args.img_format,
         )
-        sys.exit()
+        target_bgr = proxy_bgr if target_is_proxy \
+            else receive_image(target_future, args.img_format)[1]
 
     # apply proxy corrections
     rgb_corr = proxy_correct(
-        proxy_image_path,
-        target_image_path,
+        proxy_bgr_detect,
+        proxy_bgr,
+        target_bgr,
+        args.proxy_image_path,
+        args.img_format,
         ref_color_matrix,
+        args.review,
+        args.cache_masks,
     )
 
     # save
-    pil_img = Image.fromarray(rgb_corr)
-    pil_img.save(
-        output_path,
-        format="TIFF",
-        icc_profile=icc_profile,
-        compression='tiff_adobe_deflate',
-    )
+    utils.save_image(rgb_corr, args.output_path, icc_profile)
 
 if __name__ == '__main__':
     main()